@@ -1,303 +1,319 @@
-from aiogram import Router, types, F
+from aiogram import Bot, Router, types, F
 from aiogram.types import ReplyParameters, InputChecklistTask, InputChecklist
+from aiolimiter import AsyncLimiter
 from bot.services.checklist_manager import ChecklistManager
 from bot.services.business_connection_service import BusinessConnectionService
 from bot.services.user_whitelist_service import UserWhitelistService
 from bot.services.parser import TextParser
-from bot.models.database import PendingMessage, SessionLocal
+from bot.services.pending_message_writer import PendingMessageWriter
+from bot.models.database import PendingMessage, dialect_insert
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from collections import OrderedDict
 from datetime import datetime
+from typing import Optional, Tuple
 import logging
+import re
+import time
 
 logger = logging.getLogger(__name__)
 
 router = Router()
-checklist_manager = ChecklistManager()
-business_service = BusinessConnectionService()
-whitelist_service = UserWhitelistService()
 
+# Эмодзи, по которым создаётся чек-лист
+_TRIGGER_EMOJIS = ('📝', '✍️', '✍')
+_TRIGGER_SET = frozenset(_TRIGGER_EMOJIS)
+# Одна проверка текста ответа вместо поиска каждого эмодзи по отдельности
+_TRIGGER_RE = re.compile("📝|✍\uFE0F?")
 
-def get_db_session():
-    """Возвращает сессию базы данных"""
-    return SessionLocal()
+# Лимиты Telegram на отправку: ~30 сообщений в секунду глобально
+# и 1 сообщение в секунду в один чат
+_GLOBAL_LIMITER = AsyncLimiter(28, 1)
+_PER_CHAT_LIMITERS: "OrderedDict[int, AsyncLimiter]" = OrderedDict()
+_PER_CHAT_LIMITERS_MAX = 1000
+
+
+def _chat_limiter(chat_id: int) -> AsyncLimiter:
+    """Возвращает лимитер чата, вытесняя давно не использованные"""
+    limiter = _PER_CHAT_LIMITERS.get(chat_id)
+    if limiter is None:
+        limiter = _PER_CHAT_LIMITERS[chat_id] = AsyncLimiter(1, 1)
+        if len(_PER_CHAT_LIMITERS) > _PER_CHAT_LIMITERS_MAX:
+            _PER_CHAT_LIMITERS.popitem(last=False)
+    else:
+        _PER_CHAT_LIMITERS.move_to_end(chat_id)
+    return limiter
+
+
+async def _send_checklist(bot: Bot, **kwargs) -> types.Message:
+    """Отправляет чек-лист с учётом лимитов Telegram, не доводя до 429"""
+    async with _GLOBAL_LIMITER, _chat_limiter(kwargs["chat_id"]):
+        return await bot.send_checklist(**kwargs)
+
+
+# Заголовок с точностью до минуты: (номер минуты, готовая строка)
+_title_cache: Optional[Tuple[int, str]] = None
+
+
+def _title_now() -> str:
+    """Возвращает заголовок чек-листа с текущей датой и временем"""
+    global _title_cache
+    now_min = int(time.time() // 60)
+    if _title_cache is None or _title_cache[0] != now_min:
+        _title_cache = (now_min, "Список от " + datetime.now().strftime("%d.%m.%Y %H:%M"))
+    return _title_cache[1]
 
 
 @router.business_connection()
-async def handle_business_connection(connection: types.BusinessConnection):
+async def handle_business_connection(connection: types.BusinessConnection, db: AsyncSession):
     """Получаем business_connection_id при подключении"""
     try:
-        logger.info(f"Получен business_connection_id: {connection.id}")
-        logger.info(f"Детали соединения: {connection}")
-        logger.info(f"Пользователь: {connection.user.id if connection.user else 'Unknown'}")
-        logger.info(f"Дата: {connection.date}")
+        logger.info("Получен business_connection_id: %s", connection.id)
+        logger.debug("Детали соединения: %s", connection)
+        logger.debug("Пользователь: %s", connection.user.id if connection.user else 'Unknown')
+        logger.debug("Дата: %s", connection.date)
         
         # Сохраняем соединение в базу данных
         user_id = connection.user.id if connection.user else 0
-        business_service.save_connection(connection.id, user_id)
+        await BusinessConnectionService(db).save_connection(connection.id, user_id)
+        await db.commit()
         
-        logger.info(f"✅ Бизнес-соединение успешно сохранено: {connection.id}")
+        logger.info("✅ Бизнес-соединение успешно сохранено: %s", connection.id)
         
-    except Exception as e:
-        logger.error(f"Ошибка при обработке бизнес-соединения: {e}")
-        import traceback
-        traceback.print_exc()
-
+    except Exception:
+        logger.exception("Ошибка при обработке бизнес-соединения")
+
+
+async def _send_checklist_for_pending(bot: Bot, pending: PendingMessage, db: AsyncSession):
+    """Создаёт и отправляет чек-лист для сохранённого сообщения
+
+    pending должен быть уже удалён в транзакции db. Удаление фиксируется
+    вместе с чек-листом до отправки, чтобы не держать транзакцию (и блокировку
+    записи SQLite) открытой на время ожидания лимитеров и запроса к Telegram.
+    Если отправка не удалась, pending возвращается, а чек-лист удаляется.
+    """
+    # Парсим текст для получения задач
+    tasks = TextParser.parse_text(pending.text)
+    logger.debug("Распарсенные задачи: %s", tasks)
+
+    if len(tasks) < 2:
+        logger.info("Недостаточно задач для создания чек-листа")
+        await db.commit()
+        return
+
+    # Генерируем заголовок
+    title = TextParser.generate_title(tasks)
+    logger.debug("Заголовок: %s", title)
+
+    # Создаем чек-лист в базе данных
+    checklist = await ChecklistManager(db).create_checklist(
+        user_id=pending.user_id,
+        title=title,
+        tasks=tasks
+    )
+    # Короткая транзакция: удаление pending и чек-лист с задачами
+    await db.commit()
+    logger.info("Чек-лист создан с ID: %s", checklist.id)
+    logger.info("✅ Pending message удалён")
+
+    # Создаем список задач для Telegram чек-листа,
+    # обрезая текст задачи до 100 символов (лимит Telegram API)
+    mk = InputChecklistTask
+    checklist_tasks = [mk(id=str(i), text=t[:100]) for i, t in enumerate(tasks, start=1)]
+
+    # Создаем заголовок с датой и временем
+    title_with_date = _title_now()
+
+    # Создаем InputChecklist
+    input_checklist = InputChecklist(
+        title=title_with_date,
+        tasks=checklist_tasks,
+        others_can_add_tasks=False,
+        others_can_mark_tasks_as_done=True
+    )
+
+    # Отправляем нативный Telegram чек-лист через бизнес-соединение
+    logger.debug("Отправка нативного чек-листа как ответ на сообщение %s", pending.message_id)
 
-async def create_checklist_for_message(message: types.Message, original_message: PendingMessage, db):
-    """Создаёт чек-лист для сохранённого сообщения"""
     try:
-        # Парсим текст для получения задач
-        tasks = TextParser.parse_text(original_message.text)
-        logger.info(f"Распарсенные задачи: {tasks}")
+        sent_message = await _send_checklist(
+            bot,
+            business_connection_id=pending.business_connection_id,
+            chat_id=pending.chat_id,
+            checklist=input_checklist,
+            reply_parameters=ReplyParameters(message_id=pending.message_id)
+        )
+    except Exception:
+        await _restore_pending(db, pending, checklist.id)
+        raise
+    logger.info("✅ Нативный чек-лист отправлен с ID: %s", sent_message.message_id)
 
-        if len(tasks) < 2:
-            logger.info("Недостаточно задач для создания чек-листа")
-            db.delete(original_message)
-            db.commit()
-            return
+    # Вторая короткая транзакция: message_id отправленного чек-листа
+    checklist.message_id = sent_message.message_id
+    await db.commit()
 
-        # Генерируем заголовок
-        title = TextParser.generate_title(tasks)
-        logger.info(f"Заголовок: {title}")
 
-        # Создаем чек-лист в базе данных
-        checklist = checklist_manager.create_checklist(
-            user_id=original_message.user_id,
-            title=title,
-            tasks=tasks
+async def _restore_pending(db: AsyncSession, pending: PendingMessage, checklist_id: int):
+    """Компенсирующая запись после неудачной отправки: возвращает pending
+    message, чтобы повторная реакция или ответ снова создали чек-лист,
+    и удаляет неотправленный чек-лист"""
+    try:
+        await db.rollback()
+        await db.execute(
+            dialect_insert(PendingMessage).values(
+                id=pending.id,
+                chat_id=pending.chat_id,
+                message_id=pending.message_id,
+                business_connection_id=pending.business_connection_id,
+                text=pending.text,
+                user_id=pending.user_id,
+                created_at=pending.created_at
+            ).on_conflict_do_nothing()
         )
-        logger.info(f"Чек-лист создан с ID: {checklist.id}")
-
-        # Создаем список задач для Telegram чек-листа
-        checklist_tasks = []
-        for i, task_text in enumerate(tasks, start=1):
-            # Обрезаем текст задачи до 100 символов (лимит Telegram API)
-            truncated_text = task_text[:100] if len(task_text) > 100 else task_text
-            checklist_tasks.append(InputChecklistTask(
-                id=str(i),
-                text=truncated_text
-            ))
-
-        # Создаем заголовок с датой и временем
-        now = datetime.now().strftime("%d.%m.%Y %H:%M")
-        title_with_date = f"Список от {now}"
-
-        # Создаем InputChecklist
-        input_checklist = InputChecklist(
-            title=title_with_date,
-            tasks=checklist_tasks,
-            others_can_add_tasks=False,
-            others_can_mark_tasks_as_done=True
+        await ChecklistManager(db).delete_checklist(checklist_id, pending.user_id)
+        await db.commit()
+        logger.info("Pending message возвращён после ошибки отправки: message_id=%s", pending.message_id)
+    except Exception:
+        await db.rollback()
+        logger.exception(
+            "Не удалось вернуть pending message: chat_id=%s, message_id=%s",
+            pending.chat_id, pending.message_id
         )
 
-        # Отправляем нативный Telegram чек-лист через бизнес-соединение
-        logger.info(f"Отправка нативного чек-листа как ответ на сообщение {original_message.message_id}")
 
-        sent_message = await message.bot.send_checklist(
-            business_connection_id=original_message.business_connection_id,
-            chat_id=original_message.chat_id,
-            checklist=input_checklist,
-            reply_parameters=ReplyParameters(message_id=original_message.message_id)
-        )
-        logger.info(f"✅ Нативный чек-лист отправлен с ID: {sent_message.message_id}")
-
-        # Обновляем message_id в базе данных
-        checklist.message_id = sent_message.message_id
-        checklist_manager.db.commit()
-        
-        # Удаляем pending message после успешного создания чек-листа
-        db.delete(original_message)
-        db.commit()
-        logger.info("✅ Pending message удалён")
+async def create_checklist_for_message(message: types.Message, original_message: PendingMessage,
+                                       db: AsyncSession):
+    """Создаёт чек-лист для сохранённого сообщения"""
+    try:
+        await _send_checklist_for_pending(message.bot, original_message, db)
 
-    except Exception as e:
-        logger.error(f"Ошибка при создании чек-листа: {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        logger.exception("Ошибка при создании чек-листа")
 
 
 @router.business_message(F.text)
-async def handle_business_message(message: types.Message):
+async def handle_business_message(message: types.Message, db: AsyncSession,
+                                  pending_writer: PendingMessageWriter):
     """Обрабатывает текстовые бизнес-сообщения"""
     try:
-        logger.info(f"Получено бизнес-сообщение: {message.text}")
-        logger.info(f"Business connection ID: {message.business_connection_id}")
-        logger.info(f"Chat ID: {message.chat.id}")
-        logger.info(f"Reply to message: {message.reply_to_message}")
+        logger.debug("Получено бизнес-сообщение: %s", message.text)
+        logger.debug("Business connection ID: %s", message.business_connection_id)
+        logger.debug("Chat ID: %s", message.chat.id)
+        logger.debug("Reply to message: %s", message.reply_to_message)
         username = message.from_user.username if message.from_user else None
         user_id = message.from_user.id if message.from_user else None
-        logger.info(f"От пользователя: @{username} (ID: {user_id})")
+        logger.debug("От пользователя: @%s (ID: %s)", username, user_id)
 
         # Проверяем, есть ли пользователь в whitelist (по username или user_id)
-        logger.info(f"🔍 Проверка whitelist: username='{username}', user_id={user_id}")
-        all_users = whitelist_service.get_all_users()
-        logger.info(f"📋 Текущий whitelist: {all_users}")
+        whitelist_service = UserWhitelistService(db)
+        logger.debug("🔍 Проверка whitelist: username='%s', user_id=%s", username, user_id)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("📋 Текущий whitelist: %s", await whitelist_service.get_all_users())
 
-        is_allowed = whitelist_service.is_user_allowed(username, user_id)
-        logger.info(f"✅ Результат проверки: {is_allowed}")
+        is_allowed = await whitelist_service.is_user_allowed(username, user_id)
+        logger.debug("✅ Результат проверки: %s", is_allowed)
         
         if not is_allowed:
-            logger.warning(f"❌ Пользователь @{username} (ID: {user_id}) НЕ в whitelist, сообщение игнорируется")
+            logger.warning(
+                "❌ Пользователь @%s (ID: %s) НЕ в whitelist, сообщение игнорируется",
+                username, user_id
+            )
             return
         
         # Проверяем, является ли это ответом с эмодзи 📝 или ✍️
-        trigger_emojis = ['📝', '✍️', '✍']
-        has_trigger = message.reply_to_message and any(emoji in message.text for emoji in trigger_emojis)
+        has_trigger = (
+            message.reply_to_message is not None
+            and _TRIGGER_RE.search(message.text) is not None
+        )
         if has_trigger:
             logger.info("✅ Обнаружен ответ с триггер-эмодзи, ищем сохранённое сообщение")
             
             reply_message_id = message.reply_to_message.message_id
-            logger.info(f"Reply to message ID: {reply_message_id}")
+            logger.debug("Reply to message ID: %s", reply_message_id)
+            
+            # Забираем сохранённое сообщение из базы одним DELETE ... RETURNING;
+            # если отправка чек-листа не удастся, сообщение вернётся в pending
+            stmt = delete(PendingMessage).where(
+                PendingMessage.chat_id == message.chat.id,
+                PendingMessage.message_id == reply_message_id
+            ).returning(PendingMessage)
+            pending = (await db.execute(stmt)).scalar_one_or_none()
             
-            # Ищем сохранённое сообщение в базе данных
-            db = get_db_session()
-            try:
-                pending = db.query(PendingMessage).filter(
-                    PendingMessage.chat_id == message.chat.id,
-                    PendingMessage.message_id == reply_message_id
-                ).first()
-                
-                if pending:
-                    logger.info(f"✅ Найдено сохранённое сообщение: {pending.text[:50]}...")
-                    await create_checklist_for_message(message, pending, db)
-                else:
-                    logger.warning(f"Сообщение не найдено в pending_messages: chat_id={message.chat.id}, message_id={reply_message_id}")
-            finally:
-                db.close()
+            if pending:
+                logger.info("✅ Найдено сохранённое сообщение: %s...", pending.text[:50])
+                await create_checklist_for_message(message, pending, db)
+            else:
+                logger.warning(
+                    "Сообщение не найдено в pending_messages: chat_id=%s, message_id=%s",
+                    message.chat.id, reply_message_id
+                )
             return
         
         # Парсим текст для проверки количества задач
         tasks = TextParser.parse_text(message.text)
-        logger.info(f"Распарсенные задачи: {tasks}")
+        logger.debug("Распарсенные задачи: %s", tasks)
 
         if len(tasks) < 2:
             # Если слишком мало задач, просто выходим без сохранения
-            logger.info("Недостаточно задач для создания чек-листа, сообщение не сохранено")
+            logger.debug("Недостаточно задач для создания чек-листа, сообщение не сохранено")
             return
 
-        # Сохраняем сообщение в базу данных для ожидания ответа с 📝
-        db = get_db_session()
-        try:
-            pending_message = PendingMessage(
-                chat_id=message.chat.id,
-                message_id=message.message_id,
-                business_connection_id=message.business_connection_id,
-                text=message.text,
-                user_id=message.from_user.id
-            )
-            db.add(pending_message)
-            db.commit()
-            logger.info(f"✅ Сообщение сохранено для ожидания ответа с 📝/✍️: chat_id={message.chat.id}, message_id={message.message_id}")
-        finally:
-            db.close()
+        # Ставим сообщение в очередь на запись для ожидания ответа с 📝
+        pending_writer.put(
+            chat_id=message.chat.id,
+            message_id=message.message_id,
+            business_connection_id=message.business_connection_id,
+            text=message.text,
+            user_id=message.from_user.id
+        )
+        logger.info(
+            "✅ Сообщение поставлено в очередь для ожидания ответа с 📝/✍️: chat_id=%s, message_id=%s",
+            message.chat.id, message.message_id
+        )
 
-    except Exception as e:
-        logger.error(f"Ошибка при обработке бизнес-сообщения: {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        logger.exception("Ошибка при обработке бизнес-сообщения")
 
 
 @router.message_reaction()
-async def handle_message_reaction(event: types.MessageReactionUpdated):
+async def handle_message_reaction(event: types.MessageReactionUpdated, db: AsyncSession):
     """Обрабатывает реакции на сообщения (на случай если Telegram всё-таки пришлёт)"""
     try:
-        logger.info(f"Получена реакция на сообщение")
-        logger.info(f"Chat ID: {event.chat.id}")
-        logger.info(f"Message ID: {event.message_id}")
-        logger.info(f"New reactions: {event.new_reaction}")
-        logger.info(f"Old reactions: {event.old_reaction}")
+        logger.debug("Получена реакция на сообщение")
+        logger.debug("Chat ID: %s", event.chat.id)
+        logger.debug("Message ID: %s", event.message_id)
+        logger.debug("New reactions: %s", event.new_reaction)
+        logger.debug("Old reactions: %s", event.old_reaction)
         
         # Проверяем, есть ли эмодзи "📝" или "✍️" в новых реакциях
-        trigger_emojis = ['📝', '✍️', '✍']
-        has_ok_reaction = False
-        for reaction in event.new_reaction:
-            if hasattr(reaction, 'emoji') and reaction.emoji in trigger_emojis:
-                has_ok_reaction = True
-                break
+        has_ok_reaction = any(
+            getattr(reaction, 'emoji', None) in _TRIGGER_SET for reaction in event.new_reaction
+        )
         
         if not has_ok_reaction:
-            logger.info("Реакция не является '📝', игнорируем")
+            logger.debug("Реакция не является '📝', игнорируем")
             return
         
         logger.info("✅ Обнаружена реакция '📝', ищем сохранённое сообщение")
         
-        # Ищем сохранённое сообщение в базе данных
-        db = get_db_session()
-        try:
-            pending = db.query(PendingMessage).filter(
-                PendingMessage.chat_id == event.chat.id,
-                PendingMessage.message_id == event.message_id
-            ).first()
-            
-            if not pending:
-                logger.warning(f"Сообщение не найдено в pending_messages: chat_id={event.chat.id}, message_id={event.message_id}")
-                return
-            
-            logger.info(f"✅ Найдено сохранённое сообщение: {pending.text[:50]}...")
-            
-            # Создаём фейковый message объект для create_checklist_for_message
-            # К сожалению, event не имеет bot атрибута напрямую
-            # Поэтому используем альтернативный подход
-            
-            # Парсим текст для получения задач
-            tasks = TextParser.parse_text(pending.text)
-            logger.info(f"Распарсенные задачи: {tasks}")
-
-            if len(tasks) < 2:
-                logger.info("Недостаточно задач для создания чек-листа")
-                db.delete(pending)
-                db.commit()
-                return
-
-            # Генерируем заголовок
-            title = TextParser.generate_title(tasks)
-            logger.info(f"Заголовок: {title}")
-
-            # Создаем чек-лист в базе данных
-            checklist = checklist_manager.create_checklist(
-                user_id=pending.user_id,
-                title=title,
-                tasks=tasks
-            )
-            logger.info(f"Чек-лист создан с ID: {checklist.id}")
-
-            # Создаем список задач для Telegram чек-листа
-            checklist_tasks = []
-            for i, task_text in enumerate(tasks, start=1):
-                truncated_text = task_text[:100] if len(task_text) > 100 else task_text
-                checklist_tasks.append(InputChecklistTask(
-                    id=str(i),
-                    text=truncated_text
-                ))
-
-            now = datetime.now().strftime("%d.%m.%Y %H:%M")
-            title_with_date = f"Список от {now}"
-
-            input_checklist = InputChecklist(
-                title=title_with_date,
-                tasks=checklist_tasks,
-                others_can_add_tasks=False,
-                others_can_mark_tasks_as_done=True
-            )
-
-            sent_message = await event.bot.send_checklist(
-                business_connection_id=pending.business_connection_id,
-                chat_id=pending.chat_id,
-                checklist=input_checklist,
-                reply_parameters=ReplyParameters(message_id=pending.message_id)
+        # Забираем сохранённое сообщение из базы одним DELETE ... RETURNING;
+        # если отправка чек-листа не удастся, сообщение вернётся в pending
+        stmt = delete(PendingMessage).where(
+            PendingMessage.chat_id == event.chat.id,
+            PendingMessage.message_id == event.message_id
+        ).returning(PendingMessage)
+        pending = (await db.execute(stmt)).scalar_one_or_none()
+        
+        if not pending:
+            logger.warning(
+                "Сообщение не найдено в pending_messages: chat_id=%s, message_id=%s",
+                event.chat.id, event.message_id
             )
-            logger.info(f"✅ Нативный чек-лист отправлен с ID: {sent_message.message_id}")
-
-            checklist.message_id = sent_message.message_id
-            checklist_manager.db.commit()
-            
-            db.delete(pending)
-            db.commit()
-            logger.info("✅ Pending message удалён")
-
-        finally:
-            db.close()
+            return
+        
+        logger.info("✅ Найдено сохранённое сообщение: %s...", pending.text[:50])
+        
+        await _send_checklist_for_pending(event.bot, pending, db)
 
-    except Exception as e:
-        logger.error(f"Ошибка при обработке реакции на сообщение: {e}")
-        import traceback
-        traceback.print_exc()
\ No newline at end of file
+    except Exception:
+        logger.exception("Ошибка при обработке реакции на сообщение")
\ No newline at end of file
@@ -1,11 +1,11 @@
 from aiogram import Router, types, F
 from aiogram.types import Message
+from sqlalchemy.ext.asyncio import AsyncSession
 from bot.services.business_connection_service import BusinessConnectionService
 from bot.services.user_whitelist_service import UserWhitelistService
 import logging
 
 logger = logging.getLogger(__name__)
-whitelist_service = UserWhitelistService()
 
 router = Router()
 
@@ -52,11 +52,11 @@ async def handle_help(message: Message):
     )
 
 @router.message(F.text.startswith("/business"))
-async def handle_business_status(message: Message):
+async def handle_business_status(message: Message, db: AsyncSession):
     """Проверяет и отображает статус бизнес-соединения"""
     try:
-        business_service = BusinessConnectionService()
-        connection_id = business_service.get_active_connection()
+        business_service = BusinessConnectionService(db)
+        connection_id = await business_service.get_active_connection()
 
         if connection_id:
             await message.answer(
@@ -82,15 +82,15 @@ async def handle_business_status(message: Message):
 
     except Exception as e:
         await message.answer(f"❌ Ошибка при проверке статуса: {str(e)}")
-        logger.error(f"Ошибка при проверке бизнес-соединения: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Ошибка при проверке бизнес-соединения")
 
 @router.message(F.text.startswith("/adduser"))
-async def handle_add_user(message: Message):
+async def handle_add_user(message: Message, db: AsyncSession):
     """Добавляет пользователя в whitelist"""
+    whitelist_service = UserWhitelistService(db)
+
     # Проверяем права доступа
-    if not whitelist_service.is_owner(message.from_user.id):
+    if not await whitelist_service.is_owner(message.from_user.id):
         await message.answer("❌ Эта команда доступна только владельцу бота.")
         return
 
@@ -108,7 +108,8 @@ async def handle_add_user(message: Message):
         await message.answer("❌ Идентификатор пользователя не может быть пустым.")
         return
 
-    success, msg = whitelist_service.add_user(identifier, message.from_user.id)
+    success, msg = await whitelist_service.add_user(identifier, message.from_user.id)
+    await db.commit()
     if success:
         await message.answer(f"✅ {msg}")
         logger.info(f"{msg} владельцем {message.from_user.id}")
@@ -116,10 +117,12 @@ async def handle_add_user(message: Message):
         await message.answer(f"ℹ️ {msg}")
 
 @router.message(F.text.startswith("/removeuser"))
-async def handle_remove_user(message: Message):
+async def handle_remove_user(message: Message, db: AsyncSession):
     """Удаляет пользователя из whitelist"""
+    whitelist_service = UserWhitelistService(db)
+
     # Проверяем права доступа
-    if not whitelist_service.is_owner(message.from_user.id):
+    if not await whitelist_service.is_owner(message.from_user.id):
         await message.answer("❌ Эта команда доступна только владельцу бота.")
         return
 
@@ -137,7 +140,8 @@ async def handle_remove_user(message: Message):
         await message.answer("❌ Идентификатор пользователя не может быть пустым.")
         return
 
-    success, msg = whitelist_service.remove_user(identifier)
+    success, msg = await whitelist_service.remove_user(identifier)
+    await db.commit()
     if success:
         await message.answer(f"✅ {msg}")
         logger.info(f"{msg} владельцем {message.from_user.id}")
@@ -145,14 +149,16 @@ async def handle_remove_user(message: Message):
         await message.answer(f"❌ {msg}")
 
 @router.message(F.text.startswith("/users"))
-async def handle_list_users(message: Message):
+async def handle_list_users(message: Message, db: AsyncSession):
     """Выводит список разрешённых пользователей"""
+    whitelist_service = UserWhitelistService(db)
+
     # Проверяем права доступа
-    if not whitelist_service.is_owner(message.from_user.id):
+    if not await whitelist_service.is_owner(message.from_user.id):
         await message.answer("❌ Эта команда доступна только владельцу бота.")
         return
 
-    users = whitelist_service.get_all_users()
+    users = await whitelist_service.get_all_users()
 
     if not users:
         await message.answer(
@@ -1,7 +1,10 @@
 import asyncio
+import atexit
 import logging
+import queue
 import sys
 import os
+from logging.handlers import QueueHandler, QueueListener
 from typing import Any, Callable, Awaitable
 from aiogram import Bot, Dispatcher, BaseMiddleware
 from aiogram.enums import ParseMode
@@ -11,16 +14,30 @@ from aiogram.types import Update
 # Добавляем корневую директорию в Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from bot.utils.config import BOT_TOKEN
-from bot.models.database import init_db
+from bot.utils.config import config
+from bot.models.database import init_db, engine, AsyncSessionLocal
 from bot.handlers import message_handler, callback_handler
 from bot.services.business_connection_service import BusinessConnectionService
+from bot.services.pending_message_writer import PendingMessageWriter
 
-# Настройка логирования
+# Настройка логирования: цикл событий только кладёт записи в очередь,
+# а запись в stderr выполняет отдельный поток QueueListener
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(
+    logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+)
+_log_queue_handler = QueueHandler(_log_queue)
+# Полный формат применяет поток-слушатель, здесь только текст сообщения
+_log_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+log_listener = QueueListener(_log_queue, _log_stream_handler)
 logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    level=logging.DEBUG if config.debug else logging.INFO,
+    handlers=[_log_queue_handler]
 )
+log_listener.start()
+# При выходе дописываем оставшиеся в очереди записи
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 
@@ -33,48 +50,67 @@ class DebugMiddleware(BaseMiddleware):
         event: Update,
         data: dict[str, Any]
     ) -> Any:
-        logger.info("=" * 60)
-        logger.info("ПОЛУЧЕНО ОБНОВЛЕНИЕ")
-        logger.info(f"   Update ID: {event.update_id}")
+        if not logger.isEnabledFor(logging.DEBUG):
+            return await handler(event, data)
+
+        logger.debug("=" * 60)
+        logger.debug("ПОЛУЧЕНО ОБНОВЛЕНИЕ")
+        logger.debug("   Update ID: %s", event.update_id)
         
         if hasattr(event, 'business_message') and event.business_message:
             msg = event.business_message
-            logger.info("ЭТО БИЗНЕС-СООБЩЕНИЕ!")
-            logger.info(f"   Business connection ID: {msg.business_connection_id}")
-            logger.info(f"   Chat ID: {msg.chat.id}")
-            logger.info(f"   Chat type: {msg.chat.type}")
-            logger.info(f"   Text: {msg.text}")
+            logger.debug("ЭТО БИЗНЕС-СООБЩЕНИЕ!")
+            logger.debug("   Business connection ID: %s", msg.business_connection_id)
+            logger.debug("   Chat ID: %s", msg.chat.id)
+            logger.debug("   Chat type: %s", msg.chat.type)
+            logger.debug("   Text: %s", msg.text)
         elif hasattr(event, 'message_reaction') and event.message_reaction:
             reaction = event.message_reaction
-            logger.info("ЭТО РЕАКЦИЯ НА СООБЩЕНИЕ!")
-            logger.info(f"   Chat ID: {reaction.chat.id}")
-            logger.info(f"   Message ID: {reaction.message_id}")
-            logger.info(f"   New reactions: {reaction.new_reaction}")
-            logger.info(f"   Old reactions: {reaction.old_reaction}")
+            logger.debug("ЭТО РЕАКЦИЯ НА СООБЩЕНИЕ!")
+            logger.debug("   Chat ID: %s", reaction.chat.id)
+            logger.debug("   Message ID: %s", reaction.message_id)
+            logger.debug("   New reactions: %s", reaction.new_reaction)
+            logger.debug("   Old reactions: %s", reaction.old_reaction)
         elif hasattr(event, 'message') and event.message:
             msg = event.message
-            logger.info("ЭТО ОБЫЧНОЕ СООБЩЕНИЕ (не бизнес)")
-            logger.info(f"   Chat ID: {msg.chat.id}")
-            logger.info(f"   Chat type: {msg.chat.type}")
-            logger.info(f"   Business connection ID: {msg.business_connection_id}")
-            logger.info(f"   Text: {msg.text}")
+            logger.debug("ЭТО ОБЫЧНОЕ СООБЩЕНИЕ (не бизнес)")
+            logger.debug("   Chat ID: %s", msg.chat.id)
+            logger.debug("   Chat type: %s", msg.chat.type)
+            logger.debug("   Business connection ID: %s", msg.business_connection_id)
+            logger.debug("   Text: %s", msg.text)
         else:
             # Логируем все доступные поля для диагностики
-            logger.info(f"   Тип события: {type(event).__name__}")
+            logger.debug("   Тип события: %s", type(event).__name__)
             for attr in ['message_reaction', 'message_reaction_count', 'edited_message', 'callback_query']:
                 if hasattr(event, attr) and getattr(event, attr):
-                    logger.info(f"   Найдено поле: {attr}")
+                    logger.debug("   Найдено поле: %s", attr)
         
-        logger.info("=" * 60)
+        logger.debug("=" * 60)
         
         return await handler(event, data)
 
 
+class DbSessionMiddleware(BaseMiddleware):
+    """Открывает одну сессию БД на обновление и передаёт её обработчикам как db"""
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: dict[str, Any]
+    ) -> Any:
+        # Сессия берёт соединение из пула только при первом запросе,
+        # поэтому обновления без обращения к базе его не занимают
+        async with AsyncSessionLocal() as db:
+            data["db"] = db
+            return await handler(event, data)
+
+
 async def main():
     """Основная функция запуска бота"""
     # Инициализация бота
     bot = Bot(
-        token=BOT_TOKEN,
+        token=config.bot_token,
         default=DefaultBotProperties(
             parse_mode=ParseMode.HTML
         )
@@ -83,25 +119,30 @@ async def main():
     # Создание диспетчера
     dp = Dispatcher()
     
-    # Добавляем middleware для диагностики
-    dp.update.outer_middleware(DebugMiddleware())
+    # Добавляем middleware для диагностики только в отладочном режиме
+    if config.debug:
+        dp.update.outer_middleware(DebugMiddleware())
+    # Сессия БД на время обработки обновления
+    dp.update.outer_middleware(DbSessionMiddleware())
 
-    # Инициализация базы данных
-    logger.info("Инициализация базы данных...")
-    init_db()
-    logger.info("✅ База данных инициализирована")
+    # Инициализация базы данных только по явному запросу, чтобы обычный
+    # запуск не тратил время на интроспекцию схемы
+    if config.init_db:
+        logger.info("Инициализация базы данных...")
+        await init_db()
+        logger.info("✅ База данных инициализирована")
 
     # Проверка статуса бизнес-соединения
     logger.info("Проверка статуса бизнес-соединения...")
-    business_service = BusinessConnectionService()
-    connection_info = business_service.get_connection_info()
+    async with AsyncSessionLocal() as db:
+        connection_info = await BusinessConnectionService(db).get_connection_info()
     
     if connection_info:
-        logger.info(f"✅ Найдено активное бизнес-соединение:")
-        logger.info(f"   - Connection ID: {connection_info['connection_id']}")
-        logger.info(f"   - User ID: {connection_info['user_id']}")
-        logger.info(f"   - Подключено: {connection_info['connected_at']}")
-        logger.info(f"   - Обновлено: {connection_info['updated_at']}")
+        logger.info("✅ Найдено активное бизнес-соединение:")
+        logger.info("   - Connection ID: %s", connection_info['connection_id'])
+        logger.info("   - User ID: %s", connection_info['user_id'])
+        logger.info("   - Подключено: %s", connection_info['connected_at'])
+        logger.info("   - Обновлено: %s", connection_info['updated_at'])
     else:
         logger.warning("⚠️  Активное бизнес-соединение не найдено")
         logger.warning("   Бот будет ожидать подключения к бизнес-аккаунту")
@@ -110,6 +151,11 @@ async def main():
     dp.include_router(message_handler.router)
     dp.include_router(callback_handler.router)
 
+    # Фоновая запись pending-сообщений, доступна обработчикам как pending_writer
+    pending_writer = PendingMessageWriter()
+    dp["pending_writer"] = pending_writer
+    pending_writer.start()
+
     # Запуск бота
     logger.info("🚀 Запуск бота...")
     try:
@@ -119,7 +165,9 @@ async def main():
         )
     finally:
         logger.info("Остановка бота...")
+        await pending_writer.stop()
         await bot.session.close()
+        await engine.dispose()
         logger.info("✅ Бот остановлен")
 
 if __name__ == "__main__":
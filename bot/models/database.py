@@ -1,12 +1,70 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Index, event, func
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import relationship
 from datetime import datetime
-from bot.utils.config import DATABASE_URL
+from bot.utils.config import config
+
+# Асинхронные драйверы: aiosqlite для SQLite, asyncpg для PostgreSQL
+ASYNC_DATABASE_URL = (
+    config.database_url
+    .replace("sqlite:///", "sqlite+aiosqlite:///")
+    .replace("postgresql://", "postgresql+asyncpg://")
+)
+
+# Пул соединений создаётся один раз на процесс; для серверных СУБД держим
+# тёплые соединения и проверяем их перед выдачей, чтобы не платить за
+# TCP/TLS-рукопожатие на каждое обновление
+if config.database_url.startswith("sqlite"):
+    ENGINE_OPTIONS = {}
+else:
+    ENGINE_OPTIONS = {
+        "pool_size": 10,
+        "max_overflow": 40,
+        "pool_pre_ping": True,
+        "pool_recycle": 300,
+    }
 
 Base = declarative_base()
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Кэш скомпилированных запросов больше стандартных 500: все запросы сервисов
+# параметризованы и повторяются на каждом обновлении
+engine = create_async_engine(ASYNC_DATABASE_URL, query_cache_size=1200, **ENGINE_OPTIONS)
+
+if engine.url.get_backend_name() == "sqlite":
+    @event.listens_for(engine.sync_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # WAL: читатели не блокируют писателя, commit обходится одним fsync
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        # SQLite по умолчанию не проверяет внешние ключи и не выполняет ON DELETE CASCADE
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.close()
+
+
+# expire_on_commit=False: после commit объекты не перечитываются из базы,
+# долгоживущих объектов, которым нужна свежесть после commit, у бота нет
+AsyncSessionLocal = async_sessionmaker(
+    engine,
+    class_=AsyncSession,
+    autoflush=False,
+    expire_on_commit=False
+)
+
+
+def utc_now():
+    """Текущее время UTC на стороне базы, на тех же часах, что datetime.utcnow
+
+    На PostgreSQL now() в колонке TIMESTAMP WITHOUT TIME ZONE дало бы
+    локальное время сервера; CURRENT_TIMESTAMP в SQLite всегда в UTC.
+    """
+    if engine.dialect.name == "postgresql":
+        return func.timezone("utc", func.now())
+    return func.now()
 
 class BusinessConnection(Base):
     __tablename__ = "business_connections"
@@ -16,7 +74,17 @@ class BusinessConnection(Base):
     user_id = Column(Integer, nullable=False)
     is_active = Column(Boolean, default=True)
     connected_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # При обновлении время ставит сама база
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=utc_now())
+
+# Активное соединение ищется на каждом промахе кэша; частичный индекс
+# содержит только активные строки (обычно одну)
+Index(
+    "ix_bc_active",
+    BusinessConnection.is_active,
+    sqlite_where=BusinessConnection.is_active == True,
+    postgresql_where=BusinessConnection.is_active == True,
+)
 
 class Checklist(Base):
     __tablename__ = "checklists"
@@ -27,11 +95,20 @@ class Checklist(Base):
     message_id = Column(Integer, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    # Задачи удаляет сама база (ON DELETE CASCADE), ORM их не загружает
+    tasks = relationship(
+        "Task",
+        order_by="Task.position",
+        cascade="all, delete-orphan",
+        passive_deletes=True
+    )
+
 class Task(Base):
     __tablename__ = "tasks"
 
     id = Column(Integer, primary_key=True, index=True)
-    checklist_id = Column(Integer, nullable=False)
+    checklist_id = Column(Integer, ForeignKey("checklists.id", ondelete="CASCADE"),
+                          nullable=False, index=True)
     text = Column(String, nullable=False)
     completed = Column(Boolean, default=False)
     position = Column(Integer, nullable=False)
@@ -39,6 +116,10 @@ class Task(Base):
 class AllowedUser(Base):
     """Пользователи, для которых бот создаёт чек-листы"""
     __tablename__ = "allowed_users"
+    __table_args__ = (
+        # get_all_users сортирует по дате добавления
+        Index("ix_allowed_users_added_at", "added_at"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String, unique=True, nullable=True)  # без @, может быть None
@@ -50,6 +131,10 @@ class AllowedUser(Base):
 class PendingMessage(Base):
     """Сообщения, ожидающие реакции для создания чек-листа"""
     __tablename__ = "pending_messages"
+    __table_args__ = (
+        # Поиск pending-сообщения всегда идёт по паре (chat_id, message_id)
+        Index("ix_pending_chat_msg", "chat_id", "message_id", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     chat_id = Column(Integer, nullable=False)
@@ -60,12 +145,32 @@ class PendingMessage(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
 
 
-def init_db():
-    Base.metadata.create_all(bind=engine)
+def dialect_insert(model):
+    """INSERT с поддержкой ON CONFLICT для текущей СУБД (SQLite или PostgreSQL)"""
+    if engine.dialect.name == "postgresql":
+        return postgresql_insert(model)
+    return sqlite_insert(model)
+
+
+def _create_schema(conn):
+    Base.metadata.create_all(conn)
+    # create_all не добавляет индексы в уже существующие таблицы
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+async def init_db():
+    async with engine.begin() as conn:
+        await conn.run_sync(_create_schema)
+
+
+if __name__ == "__main__":
+    # Однократное создание схемы при установке/деплое:
+    # python -m bot.models.database
+    import asyncio
+
+    async def _main():
+        await init_db()
+        await engine.dispose()
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
\ No newline at end of file
+    asyncio.run(_main())
@@ -1,179 +1,235 @@
-from datetime import datetime
-from sqlalchemy.orm import Session
+from sqlalchemy import event, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Optional
-from bot.models.database import BusinessConnection, SessionLocal
+from bot.models.database import BusinessConnection, dialect_insert, engine, utc_now
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
+ACTIVE_CONNECTION_CACHE_TTL = 60  # секунд
+
 
 class BusinessConnectionService:
-    """Сервис для управления бизнес-соединениями"""
-    
-    def __init__(self):
-        self.db: Session = SessionLocal()
-    
-    def save_connection(self, connection_id: str, user_id: int) -> BusinessConnection:
+    """Сервис для управления бизнес-соединениями
+
+    Работает в сессии вызывающего кода: изменения только отправляются в базу
+    (flush), фиксирует транзакцию вызывающий код.
+    """
+
+    # Кэш активного соединения общий для всех экземпляров сервиса: оно
+    # меняется только при подключении бизнес-аккаунта
+    _active_info: Optional[dict] = None
+    _active_expires_at: float = 0.0
+    # Увеличивается при каждом сбросе кэша: загрузка, начатая до сброса,
+    # не должна продлевать старый снимок
+    _active_generation: int = 0
+
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+    @classmethod
+    def _invalidate_cache(cls) -> None:
+        """Сбрасывает кэш активного соединения, следующий запрос перечитает таблицу"""
+        cls._active_generation += 1
+        cls._active_expires_at = 0.0
+
+    def _invalidate_cache_on_commit(self) -> None:
+        """Сбрасывает кэш после commit транзакции вызывающего кода: при сбросе
+        до commit параллельная загрузка закэширует старое соединение"""
+        event.listen(
+            self.db.sync_session, "after_commit",
+            lambda session: self._invalidate_cache(), once=True
+        )
+
+    async def _get_active_info(self) -> Optional[dict]:
+        """Возвращает информацию об активном соединении из кэша или из базы"""
+        cls = type(self)
+        if time.monotonic() < cls._active_expires_at:
+            return cls._active_info
+
+        generation = cls._active_generation
+        # Только нужные колонки: строка без ORM-объекта и identity map
+        row = (await self.db.execute(
+            select(
+                BusinessConnection.connection_id,
+                BusinessConnection.user_id,
+                BusinessConnection.connected_at,
+                BusinessConnection.updated_at
+            ).where(BusinessConnection.is_active == True)
+        )).first()
+
+        info = row._asdict() if row else None
+        # Если кэш сбросили во время загрузки, снимок мог устареть
+        # и в кэш не попадает
+        if generation == cls._active_generation:
+            cls._active_info = info
+            cls._active_expires_at = time.monotonic() + ACTIVE_CONNECTION_CACHE_TTL
+        return info
+
+    async def save_connection(self, connection_id: str, user_id: int) -> BusinessConnection:
         """
         Сохраняет новое бизнес-соединение или обновляет существующее
-        
+
         Args:
             connection_id: ID бизнес-соединения из Telegram
             user_id: ID пользователя-владельца бизнес-аккаунта
-            
+
         Returns:
             Объект BusinessConnection
         """
         try:
-            # Проверяем, есть ли уже такое соединение
-            existing = self.db.query(BusinessConnection).filter(
-                BusinessConnection.connection_id == connection_id
-            ).first()
-            
-            if existing:
-                # Обновляем существующее соединение
-                existing.user_id = user_id
-                existing.is_active = True
-                existing.updated_at = datetime.utcnow()
-                logger.info(f"Обновлено бизнес-соединение: {connection_id}")
-            else:
-                # Деактивируем все старые соединения (поддержка только одного активного)
-                self.db.query(BusinessConnection).update({"is_active": False})
-                
-                # Создаем новое соединение
-                existing = BusinessConnection(
-                    connection_id=connection_id,
-                    user_id=user_id,
-                    is_active=True
+            # Деактивируем все остальные соединения (поддержка только одного активного)
+            deactivate = (
+                update(BusinessConnection)
+                .where(
+                    BusinessConnection.connection_id != connection_id,
+                    BusinessConnection.is_active == True
                 )
-                self.db.add(existing)
-                logger.info(f"Создано новое бизнес-соединение: {connection_id}")
-            
-            self.db.commit()
-            self.db.refresh(existing)
-            return existing
-            
+                .values(is_active=False)
+            )
+
+            # Создаем соединение или обновляем существующее одним UPSERT
+            stmt = dialect_insert(BusinessConnection).values(
+                connection_id=connection_id,
+                user_id=user_id,
+                is_active=True
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[BusinessConnection.connection_id],
+                set_={
+                    "user_id": stmt.excluded.user_id,
+                    "is_active": True,
+                    # onupdate колонки на ON CONFLICT DO UPDATE не действует
+                    "updated_at": utc_now()
+                }
+            ).returning(BusinessConnection)
+
+            if engine.dialect.name == "postgresql":
+                # PostgreSQL выполняет UPDATE внутри WITH: один запрос вместо двух
+                stmt = stmt.add_cte(deactivate.cte("deactivated"))
+            else:
+                # SQLite не поддерживает UPDATE в WITH
+                await self.db.execute(deactivate)
+
+            connection = (await self.db.execute(
+                stmt, execution_options={"populate_existing": True}
+            )).scalar_one()
+
+            self._invalidate_cache_on_commit()
+            logger.info(f"Сохранено бизнес-соединение: {connection_id}")
+            return connection
+
         except Exception as e:
-            self.db.rollback()
+            await self.db.rollback()
             logger.error(f"Ошибка при сохранении бизнес-соединения: {e}")
             raise
-    
-    def get_active_connection(self) -> Optional[str]:
+
+    async def get_active_connection(self) -> Optional[str]:
         """
         Получает ID активного бизнес-соединения
-        
+
         Returns:
             connection_id или None, если активного соединения нет
         """
         try:
-            connection = self.db.query(BusinessConnection).filter(
-                BusinessConnection.is_active == True
-            ).first()
-            
-            if connection:
-                logger.debug(f"Найдено активное соединение: {connection.connection_id}")
-                return connection.connection_id
+            info = await self._get_active_info()
+
+            if info:
+                logger.debug(f"Найдено активное соединение: {info['connection_id']}")
+                return info["connection_id"]
             else:
                 logger.debug("Активное бизнес-соединение не найдено")
                 return None
-                
+
         except Exception as e:
             logger.error(f"Ошибка при получении активного соединения: {e}")
             return None
-    
-    def deactivate_connection(self, connection_id: str = None) -> bool:
+
+    async def deactivate_connection(self, connection_id: str = None) -> bool:
         """
         Деактивирует бизнес-соединение
-        
+
         Args:
-            connection_id: ID соединения для деактивации. 
+            connection_id: ID соединения для деактивации.
                           Если None, деактивирует все активные соединения.
-        
+
         Returns:
             True если соединение было деактивировано, False иначе
         """
         try:
             if connection_id:
                 # Деактивируем конкретное соединение
-                result = self.db.query(BusinessConnection).filter(
-                    BusinessConnection.connection_id == connection_id
-                ).update({"is_active": False, "updated_at": datetime.utcnow()})
+                result = await self.db.execute(
+                    update(BusinessConnection)
+                    .where(BusinessConnection.connection_id == connection_id)
+                    .values(is_active=False)
+                )
                 logger.info(f"Деактивировано соединение: {connection_id}")
             else:
                 # Деактивируем все активные соединения
-                result = self.db.query(BusinessConnection).filter(
-                    BusinessConnection.is_active == True
-                ).update({"is_active": False, "updated_at": datetime.utcnow()})
+                result = await self.db.execute(
+                    update(BusinessConnection)
+                    .where(BusinessConnection.is_active == True)
+                    .values(is_active=False)
+                )
                 logger.info("Деактивированы все активные соединения")
-            
-            self.db.commit()
-            return result > 0
-            
+
+            self._invalidate_cache_on_commit()
+            return result.rowcount > 0
+
         except Exception as e:
-            self.db.rollback()
+            await self.db.rollback()
             logger.error(f"Ошибка при деактивации соединения: {e}")
             return False
-    
-    def update_connection(self, connection_id: str, user_id: int) -> Optional[BusinessConnection]:
+
+    async def update_connection(self, connection_id: str, user_id: int) -> Optional[BusinessConnection]:
         """
         Обновляет существующее бизнес-соединение
-        
+
         Args:
             connection_id: ID бизнес-соединения
             user_id: Новый ID пользователя
-            
+
         Returns:
             Обновленный объект BusinessConnection или None
         """
         try:
-            connection = self.db.query(BusinessConnection).filter(
-                BusinessConnection.connection_id == connection_id
-            ).first()
-            
+            # updated_at выставляет база (onupdate=utc_now()), RETURNING
+            # сразу возвращает его значение в объект
+            connection = (await self.db.execute(
+                update(BusinessConnection)
+                .where(BusinessConnection.connection_id == connection_id)
+                .values(user_id=user_id, is_active=True)
+                .returning(BusinessConnection),
+                execution_options={"populate_existing": True}
+            )).scalar_one_or_none()
+
             if connection:
-                connection.user_id = user_id
-                connection.is_active = True
-                connection.updated_at = datetime.utcnow()
-                self.db.commit()
-                self.db.refresh(connection)
+                self._invalidate_cache_on_commit()
                 logger.info(f"Обновлено соединение {connection_id} для пользователя {user_id}")
                 return connection
             else:
                 logger.warning(f"Соединение {connection_id} не найдено для обновления")
                 return None
-                
+
         except Exception as e:
-            self.db.rollback()
+            await self.db.rollback()
             logger.error(f"Ошибка при обновлении соединения: {e}")
             return None
-    
-    def get_connection_info(self) -> Optional[dict]:
+
+    async def get_connection_info(self) -> Optional[dict]:
         """
         Получает информацию об активном соединении
-        
+
         Returns:
             Словарь с информацией о соединении или None
         """
         try:
-            connection = self.db.query(BusinessConnection).filter(
-                BusinessConnection.is_active == True
-            ).first()
-            
-            if connection:
-                return {
-                    "connection_id": connection.connection_id,
-                    "user_id": connection.user_id,
-                    "connected_at": connection.connected_at,
-                    "updated_at": connection.updated_at
-                }
-            return None
-            
+            info = await self._get_active_info()
+            # Копия, чтобы вызывающий код не мог испортить кэш
+            return dict(info) if info else None
+
         except Exception as e:
             logger.error(f"Ошибка при получении информации о соединении: {e}")
             return None
-    
-    def __del__(self):
-        """Закрываем сессию при удалении объекта"""
-        if hasattr(self, 'db'):
-            self.db.close()
-
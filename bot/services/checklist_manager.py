@@ -1,65 +1,86 @@
-from typing import List, Optional
-from sqlalchemy.orm import Session
-from bot.models.database import Checklist, Task, get_db
+from typing import List, Optional, Sequence
+from sqlalchemy import select, insert, update, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from bot.models.database import Checklist, Task
 
 class ChecklistManager:
-    """Управление чек-листами"""
+    """Управление чек-листами
 
-    def __init__(self):
-        self.db_gen = get_db()
-        self.db = next(self.db_gen)
+    Работает в сессии вызывающего кода: изменения только отправляются в базу
+    (flush), фиксирует транзакцию вызывающий код.
+    """
 
-    def create_checklist(self, user_id: int, title: str, tasks: List[str]) -> Checklist:
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+    async def create_checklist(self, user_id: int, title: str, tasks: Sequence[str]) -> Checklist:
         """Создает новый чек-лист в базе данных"""
-        checklist = Checklist(
-            user_id=user_id,
-            title=title,
-            message_id=0  # Будет установлен после отправки
-        )
-        self.db.add(checklist)
-        self.db.commit()
-        self.db.refresh(checklist)
+        # INSERT ... RETURNING сразу отдаёт чек-лист с id и значениями
+        # по умолчанию, без flush и повторного SELECT
+        checklist = (await self.db.execute(
+            insert(Checklist).values(
+                user_id=user_id,
+                title=title,
+                message_id=0  # Будет установлен после отправки
+            ).returning(Checklist)
+        )).scalar_one()
 
-        # Добавляем задачи
-        for i, task_text in enumerate(tasks):
-            task = Task(
-                checklist_id=checklist.id,
-                text=task_text,
-                position=i
-            )
-            self.db.add(task)
+        # Добавляем все задачи одним пакетным INSERT
+        if tasks:
+            await self.db.execute(insert(Task), [
+                {"checklist_id": checklist.id, "text": task_text, "position": i}
+                for i, task_text in enumerate(tasks)
+            ])
 
-        self.db.commit()
         return checklist
 
-    def get_checklist(self, checklist_id: int) -> Optional[Checklist]:
-        """Получает чек-лист по ID"""
-        return self.db.query(Checklist).filter(Checklist.id == checklist_id).first()
+    async def get_checklist(self, checklist_id: int) -> Optional[Checklist]:
+        """Получает чек-лист по ID вместе с задачами"""
+        result = await self.db.execute(
+            select(Checklist)
+            .options(selectinload(Checklist.tasks))
+            .where(Checklist.id == checklist_id)
+        )
+        return result.scalars().first()
 
-    def get_user_checklists(self, user_id: int) -> List[Checklist]:
-        """Получает все чек-листы пользователя"""
-        return self.db.query(Checklist).filter(Checklist.user_id == user_id).all()
+    async def get_user_checklists(self, user_id: int) -> List[Checklist]:
+        """Получает все чек-листы пользователя вместе с задачами"""
+        # Задачи всех чек-листов загружаются одним дополнительным запросом
+        result = await self.db.execute(
+            select(Checklist)
+            .options(selectinload(Checklist.tasks))
+            .where(Checklist.user_id == user_id)
+        )
+        return list(result.scalars().all())
 
-    def update_task_status(self, task_id: int, completed: bool) -> bool:
+    async def update_task_status(self, task_id: int, completed: bool) -> bool:
         """Обновляет статус задачи"""
-        task = self.db.query(Task).filter(Task.id == task_id).first()
-        if task:
-            task.completed = completed
-            self.db.commit()
-            return True
-        return False
+        # Один UPDATE по первичному ключу без предварительной загрузки задачи
+        result = await self.db.execute(
+            update(Task).where(Task.id == task_id).values(completed=completed)
+        )
+        return result.rowcount > 0
 
-    def delete_checklist(self, checklist_id: int, user_id: int) -> bool:
-        """Удаляет чек-лист"""
-        checklist = self.db.query(Checklist).filter(
+    async def delete_checklist(self, checklist_id: int, user_id: int) -> bool:
+        """Удаляет чек-лист вместе с задачами"""
+        # Без предварительного SELECT. Задачи удаляются явно: в базах,
+        # созданных до появления внешнего ключа, ON DELETE CASCADE нет,
+        # а SQLite повторно выдаёт id последнего удалённого чек-листа
+        owned = select(Checklist.id).where(
             Checklist.id == checklist_id,
             Checklist.user_id == user_id
-        ).first()
-        if checklist:
-            # Удаляем связанные задачи
-            self.db.query(Task).filter(Task.checklist_id == checklist_id).delete()
-            # Удаляем чек-лист
-            self.db.delete(checklist)
-            self.db.commit()
-            return True
-        return False
\ No newline at end of file
+        )
+        await self.db.execute(
+            delete(Task).where(
+                Task.checklist_id == checklist_id,
+                Task.checklist_id.in_(owned)
+            )
+        )
+        result = await self.db.execute(
+            delete(Checklist).where(
+                Checklist.id == checklist_id,
+                Checklist.user_id == user_id
+            )
+        )
+        return result.rowcount > 0
@@ -1,13 +1,34 @@
 import re
-from typing import List
+from functools import lru_cache
+from typing import List, Sequence, Tuple
+
+# Шаблоны компилируются один раз при импорте модуля
+_NUMBERED = re.compile(r'^\d+\.\s*(.+?)(?:\n|$)', re.MULTILINE)
+# Маркированные списки: (символы маркера, шаблон)
+_BULLETS = (
+    ('•·', re.compile(r'^[•·]\s*(.+?)(?:\n|$)', re.MULTILINE)),
+    ('-*', re.compile(r'^[-*]\s*(.+?)(?:\n|$)', re.MULTILINE)),
+    ('-', re.compile(r'^-\s*\[(.*?)\]\s*(.+?)(?:\n|$)', re.MULTILINE)),  # Markdown чекбоксы
+)
+_CHECKBOX = _BULLETS[2][1]
+_BRACKETS = '()[]{}'
+_SEPARATORS = (
+    re.compile(r'\s+\|\s+'),
+    re.compile(r'\s+и\s+'),
+    re.compile(r'\s+\+\s+'),
+)
 
 class TextParser:
     """Парсер текста для создания чек-листов"""
 
     @staticmethod
-    def parse_text(text: str) -> List[str]:
+    @lru_cache(maxsize=256)
+    def parse_text(text: str) -> Tuple[str, ...]:
         """
-        Парсит входной текст и возвращает список задач
+        Парсит входной текст и возвращает кортеж задач
+
+        Результат кэшируется: один и тот же текст разбирается при сохранении
+        сообщения и повторно при создании чек-листа по ответу или реакции.
 
         Поддерживаемые форматы:
         - Разделенные запятыми: Молоко, Хлеб, Сыр
@@ -15,25 +36,29 @@ class TextParser:
         - Маркированные списки: • Молоко\n• Хлеб\n• Сыр
         - Построчно: Молоко\nХлеб\nСыр
         """
+        return tuple(TextParser._split_tasks(text))
+
+    @staticmethod
+    def _split_tasks(text: str) -> List[str]:
+        """Разбивает текст на задачи (см. parse_text)"""
         text = text.strip()
 
+        # Каждый шаблон списка сканирует весь текст, поэтому запускаем его,
+        # только если в тексте вообще есть символ его маркера
+
         # Проверяем нумерованные списки
-        numbered_pattern = r'^\d+\.\s*(.+?)(?:\n|$)'
-        numbered_matches = re.findall(numbered_pattern, text, re.MULTILINE)
-        if numbered_matches:
-            return [task.strip() for task in numbered_matches if task.strip()]
+        if '.' in text:
+            numbered_matches = _NUMBERED.findall(text)
+            if numbered_matches:
+                return [task.strip() for task in numbered_matches if task.strip()]
 
         # Проверяем маркированные списки
-        bullet_patterns = [
-            r'^[•·]\s*(.+?)(?:\n|$)',
-            r'^[-*]\s*(.+?)(?:\n|$)',
-            r'^-\s*\[(.*?)\]\s*(.+?)(?:\n|$)'  # Markdown чекбоксы
-        ]
-
-        for pattern in bullet_patterns:
-            bullet_matches = re.findall(pattern, text, re.MULTILINE)
+        for markers, pattern in _BULLETS:
+            if not any(marker in text for marker in markers):
+                continue
+            bullet_matches = pattern.findall(text)
             if bullet_matches:
-                if pattern == bullet_patterns[2]:  # Markdown чекбоксы
+                if pattern is _CHECKBOX:
                     return [task.strip() for task, _ in bullet_matches if task.strip()]
                 else:
                     return [task.strip() for task in bullet_matches if task.strip()]
@@ -41,24 +66,30 @@ class TextParser:
         # Проверяем разделенные запятыми (игнорируем запятые внутри скобок)
         # (только если нет переносов строк - иначе это формат с переносами)
         if ',' in text and '\n' not in text:
-            # Разбиваем по запятым, но не внутри скобок
-            parts = []
-            current = ""
-            depth = 0
-            for char in text:
-                if char in '([{':
-                    depth += 1
-                    current += char
-                elif char in ')]}':
-                    depth -= 1
-                    current += char
-                elif char == ',' and depth == 0:
+            if not any(ch in text for ch in _BRACKETS):
+                # Скобок нет - достаточно обычного split
+                parts = [part.strip() for part in text.split(',')]
+                if not parts[-1]:
+                    parts.pop()
+            else:
+                # Разбиваем по запятым, но не внутри скобок
+                parts = []
+                current = ""
+                depth = 0
+                for char in text:
+                    if char in '([{':
+                        depth += 1
+                        current += char
+                    elif char in ')]}':
+                        depth -= 1
+                        current += char
+                    elif char == ',' and depth == 0:
+                        parts.append(current.strip())
+                        current = ""
+                    else:
+                        current += char
+                if current.strip():
                     parts.append(current.strip())
-                    current = ""
-                else:
-                    current += char
-            if current.strip():
-                parts.append(current.strip())
 
             # Возвращаем только если получилось больше одной части
             if len(parts) > 1:
@@ -80,15 +111,14 @@ class TextParser:
         if len(lines) == 1:
             line = lines[0]
             # Разные разделители
-            separators = [r'\s+\|\s+', r'\s+и\s+', r'\s+\+\s+']
-            for sep in separators:
-                if re.search(sep, line):
-                    return [task.strip() for task in re.split(sep, line) if task.strip()]
+            for sep in _SEPARATORS:
+                if sep.search(line):
+                    return [task.strip() for task in sep.split(line) if task.strip()]
 
         return lines
 
     @staticmethod
-    def generate_title(tasks: List[str]) -> str:
+    def generate_title(tasks: Sequence[str]) -> str:
         """Генерирует заголовок для чек-листа на основе задач"""
         if not tasks:
             return "Мой список"
@@ -96,6 +126,7 @@ class TextParser:
         if len(tasks) == 1:
             return tasks[0]
         elif len(tasks) <= 3:
-            return f"Список: {', '.join(tasks[:2])}..."
+            # Здесь задач 2 или 3: берём первые две без среза и join
+            return f"Список: {tasks[0]}, {tasks[1]}..."
         else:
             return f"Список из {len(tasks)} пунктов"
\ No newline at end of file
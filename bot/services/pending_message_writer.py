@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+from sqlalchemy import insert
+from sqlalchemy.exc import DBAPIError, IntegrityError, OperationalError
+from bot.models.database import PendingMessage, AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+class PendingMessageWriter:
+    """Фоновая пакетная запись pending-сообщений
+
+    Обработчик только кладёт сообщение в очередь и сразу возвращается,
+    а фоновая задача записывает накопленные сообщения одним INSERT.
+    Временные ошибки базы (например, "database is locked") повторяются
+    с экспоненциальной задержкой.
+    """
+
+    def __init__(self, batch_size: int = 100, flush_interval: float = 0.2,
+                 max_attempts: int = 5, retry_delay: float = 0.1):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    def put(self, chat_id: int, message_id: int, business_connection_id: str,
+            text: str, user_id: int) -> None:
+        """Ставит сообщение в очередь на запись"""
+        self.queue.put_nowait({
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "business_connection_id": business_connection_id,
+            "text": text,
+            "user_id": user_id,
+        })
+
+    def start(self) -> None:
+        """Запускает фоновую задачу записи"""
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Дописывает всё, что осталось в очереди, и останавливает задачу"""
+        if self._task is None:
+            return
+        self.queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+
+            # Собираем пачку: до batch_size сообщений или flush_interval секунд
+            batch = [item]
+            stopping = False
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await self._write_batch(batch)
+            if stopping:
+                return
+
+    async def _insert(self, rows: List[dict]) -> None:
+        """Записывает строки одним INSERT, повторяя его при временных ошибках базы"""
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                async with AsyncSessionLocal() as db:
+                    await db.execute(insert(PendingMessage), rows)
+                    await db.commit()
+                return
+            except IntegrityError:
+                raise
+            except DBAPIError as e:
+                transient = isinstance(e, OperationalError) or e.connection_invalidated
+                if not transient or attempt == self.max_attempts:
+                    raise
+                delay = self.retry_delay * 2 ** (attempt - 1)
+                logger.warning(
+                    "Временная ошибка при сохранении pending-сообщений "
+                    "(попытка %s из %s), повтор через %.1f с: %s",
+                    attempt, self.max_attempts, delay, e.orig
+                )
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    def _row_keys(rows: List[dict]) -> List[Tuple[int, int]]:
+        return [(row["chat_id"], row["message_id"]) for row in rows]
+
+    async def _write_batch(self, batch: List[dict]) -> None:
+        try:
+            await self._insert(batch)
+            logger.info("✅ Сохранено pending-сообщений: %s", len(batch))
+        except IntegrityError:
+            # В пачке есть уже сохранённое сообщение: пишем по одному,
+            # чтобы не потерять остальные
+            for row in batch:
+                await self._write_one(row)
+        except Exception:
+            logger.exception(
+                "Не удалось сохранить pending-сообщения (chat_id, message_id): %s",
+                self._row_keys(batch)
+            )
+
+    async def _write_one(self, row: dict) -> None:
+        try:
+            await self._insert([row])
+        except IntegrityError:
+            logger.warning(
+                "Сообщение уже сохранено: chat_id=%s, message_id=%s",
+                row["chat_id"], row["message_id"]
+            )
+        except Exception:
+            logger.exception(
+                "Не удалось сохранить pending-сообщение: chat_id=%s, message_id=%s",
+                row["chat_id"], row["message_id"]
+            )
@@ -1,34 +1,87 @@
-from typing import List, Optional, Tuple, Union
-from sqlalchemy import or_
-from bot.models.database import AllowedUser, BusinessConnection, SessionLocal
+from functools import lru_cache
+from typing import List, Optional, Set, Tuple, Union
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from bot.models.database import AllowedUser, dialect_insert
+from bot.services.business_connection_service import BusinessConnectionService
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
+WHITELIST_CACHE_TTL = 60  # секунд
+
+
+@lru_cache(maxsize=1024)
+def _parse_identifier(identifier: str) -> Tuple[Optional[str], Optional[int]]:
+    """Определяет тип идентификатора: username или user_id
+
+    Returns:
+        (username, None) если это username
+        (None, user_id) если это числовой ID
+    """
+    identifier = identifier.strip().lstrip('@')
+
+    # Если состоит только из цифр - это user_id
+    if identifier.isdigit():
+        return None, int(identifier)
+
+    # Иначе это username
+    return identifier.lower(), None
+
 
 class UserWhitelistService:
-    """Сервис управления списком разрешённых пользователей"""
+    """Сервис управления списком разрешённых пользователей
 
-    def __init__(self):
-        self.db = SessionLocal()
+    Работает в сессии вызывающего кода: изменения только отправляются в базу
+    (flush), фиксирует транзакцию вызывающий код.
+    """
 
-    def _parse_identifier(self, identifier: str) -> Tuple[Optional[str], Optional[int]]:
-        """Определяет тип идентификатора: username или user_id
-        
-        Returns:
-            (username, None) если это username
-            (None, user_id) если это числовой ID
-        """
-        identifier = identifier.strip().lstrip('@')
-        
-        # Если состоит только из цифр - это user_id
-        if identifier.isdigit():
-            return None, int(identifier)
-        
-        # Иначе это username
-        return identifier.lower(), None
+    # Кэш whitelist общий для всех экземпляров сервиса, чтобы изменения
+    # через команды владельца сразу видели и обработчики бизнес-сообщений
+    _usernames: Set[str] = set()
+    _user_ids: Set[int] = set()
+    _cache_expires_at: float = 0.0
+    # Увеличивается при каждом сбросе кэша: загрузка, начатая до сброса,
+    # не должна продлевать старый снимок
+    _cache_generation: int = 0
+
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+    @classmethod
+    def _invalidate_cache(cls) -> None:
+        """Сбрасывает кэш whitelist, следующая проверка перечитает таблицу"""
+        cls._cache_generation += 1
+        cls._cache_expires_at = 0.0
+
+    def _invalidate_cache_on_commit(self) -> None:
+        """Сбрасывает кэш после commit транзакции вызывающего кода: при сбросе
+        до commit параллельная загрузка закэширует старый whitelist"""
+        event.listen(
+            self.db.sync_session, "after_commit",
+            lambda session: self._invalidate_cache(), once=True
+        )
 
-    def add_user(self, identifier: str, added_by: int) -> Tuple[bool, str]:
+    async def _load_cache(self) -> None:
+        """Перечитывает whitelist из базы, если кэш устарел"""
+        cls = type(self)
+        if time.monotonic() < cls._cache_expires_at:
+            return
+
+        generation = cls._cache_generation
+        rows = (await self.db.execute(
+            select(AllowedUser.username, AllowedUser.telegram_user_id)
+        )).all()
+
+        cls._usernames = {username for username, _ in rows if username}
+        cls._user_ids = {user_id for _, user_id in rows if user_id}
+        # Если кэш сбросили во время загрузки, снимок мог устареть:
+        # используем его только для текущей проверки
+        if generation == cls._cache_generation:
+            cls._cache_expires_at = time.monotonic() + WHITELIST_CACHE_TTL
+
+    async def add_user(self, identifier: str, added_by: int) -> Tuple[bool, str]:
         """Добавляет пользователя в whitelist
         
         Args:
@@ -38,34 +91,28 @@ class UserWhitelistService:
         Returns:
             (success, message) - результат и сообщение
         """
-        username, user_id = self._parse_identifier(identifier)
-        
-        # Проверяем, есть ли уже
-        if username:
-            existing = self.db.query(AllowedUser).filter(
-                AllowedUser.username == username
-            ).first()
-            display_name = f"@{username}"
-        else:
-            existing = self.db.query(AllowedUser).filter(
-                AllowedUser.telegram_user_id == user_id
-            ).first()
-            display_name = f"ID:{user_id}"
-        
-        if existing:
-            return False, f"Пользователь {display_name} уже в списке"
+        username, user_id = _parse_identifier(identifier)
+        display_name = f"@{username}" if username else f"ID:{user_id}"
         
-        user = AllowedUser(
+        # Проверка и вставка одним запросом: если пользователь уже есть,
+        # ON CONFLICT DO NOTHING ничего не вставит и RETURNING будет пуст
+        stmt = dialect_insert(AllowedUser).values(
             username=username,
             telegram_user_id=user_id,
             added_by=added_by
-        )
-        self.db.add(user)
-        self.db.commit()
+        ).on_conflict_do_nothing(
+            index_elements=[AllowedUser.username if username else AllowedUser.telegram_user_id]
+        ).returning(AllowedUser.id)
+        inserted_id = (await self.db.execute(stmt)).scalar_one_or_none()
+            
+        if inserted_id is None:
+            return False, f"Пользователь {display_name} уже в списке"
+            
+        self._invalidate_cache_on_commit()
         logger.info(f"Пользователь {display_name} добавлен в whitelist")
         return True, f"Пользователь {display_name} добавлен в список"
 
-    def remove_user(self, identifier: str) -> Tuple[bool, str]:
+    async def remove_user(self, identifier: str) -> Tuple[bool, str]:
         """Удаляет пользователя из whitelist
         
         Args:
@@ -74,34 +121,37 @@ class UserWhitelistService:
         Returns:
             (success, message) - результат и сообщение
         """
-        username, user_id = self._parse_identifier(identifier)
+        username, user_id = _parse_identifier(identifier)
         
         if username:
-            user = self.db.query(AllowedUser).filter(
-                AllowedUser.username == username
-            ).first()
+            user = (await self.db.execute(
+                select(AllowedUser).where(AllowedUser.username == username)
+            )).scalars().first()
             display_name = f"@{username}"
         else:
-            user = self.db.query(AllowedUser).filter(
-                AllowedUser.telegram_user_id == user_id
-            ).first()
+            user = (await self.db.execute(
+                select(AllowedUser).where(AllowedUser.telegram_user_id == user_id)
+            )).scalars().first()
             display_name = f"ID:{user_id}"
-        
+            
         if not user:
             return False, f"Пользователь {display_name} не найден в списке"
-        
-        self.db.delete(user)
-        self.db.commit()
+            
+        await self.db.delete(user)
+        await self.db.flush()
+        self._invalidate_cache_on_commit()
         logger.info(f"Пользователь {display_name} удалён из whitelist")
         return True, f"Пользователь {display_name} удалён из списка"
 
-    def get_all_users(self) -> List[str]:
+    async def get_all_users(self) -> List[str]:
         """Возвращает список всех пользователей в whitelist
         
         Returns:
             Список строк вида "@username" или "ID:123456"
         """
-        users = self.db.query(AllowedUser).order_by(AllowedUser.added_at).all()
+        users = (await self.db.execute(
+            select(AllowedUser).order_by(AllowedUser.added_at)
+        )).scalars().all()
         result = []
         for user in users:
             if user.username:
@@ -110,7 +160,7 @@ class UserWhitelistService:
                 result.append(f"ID:{user.telegram_user_id}")
         return result
 
-    def is_user_allowed(self, username: Optional[str], user_id: Optional[int] = None) -> bool:
+    async def is_user_allowed(self, username: Optional[str], user_id: Optional[int] = None) -> bool:
         """Проверяет, есть ли пользователь в whitelist
         
         Args:
@@ -120,34 +170,26 @@ class UserWhitelistService:
         Returns:
             True если пользователь в списке
         """
-        conditions = []
-        
-        if username:
-            conditions.append(AllowedUser.username == username.lower())
-        
-        if user_id:
-            conditions.append(AllowedUser.telegram_user_id == user_id)
-        
-        if not conditions:
+        if not username and not user_id:
             return False
         
-        exists = self.db.query(AllowedUser).filter(
-            or_(*conditions)
-        ).first() is not None
+        await self._load_cache()
+        
+        if username and username.lower() in self._usernames:
+            return True
         
-        return exists
+        return bool(user_id) and user_id in self._user_ids
 
-    def get_owner_id(self) -> Optional[int]:
+    async def get_owner_id(self) -> Optional[int]:
         """Получает user_id владельца бота (из активного бизнес-соединения)"""
-        connection = self.db.query(BusinessConnection).filter(
-            BusinessConnection.is_active == True
-        ).first()
+        # Активное соединение кэшируется в BusinessConnectionService
+        info = await BusinessConnectionService(self.db).get_connection_info()
         
-        if connection:
-            return connection.user_id
+        if info:
+            return info["user_id"]
         return None
 
-    def is_owner(self, user_id: int) -> bool:
+    async def is_owner(self, user_id: int) -> bool:
         """Проверяет, является ли пользователь владельцем бота"""
-        owner_id = self.get_owner_id()
+        owner_id = await self.get_owner_id()
         return owner_id is not None and owner_id == user_id
@@ -1,10 +1,34 @@
 import os
+from dataclasses import dataclass
 from dotenv import load_dotenv
 
 load_dotenv()
 
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///checklist_bot.db")
 
-if not BOT_TOKEN:
-    raise ValueError("BOT_TOKEN не найден в переменных окружения!")
\ No newline at end of file
+@dataclass(frozen=True)
+class Config:
+    """Настройки бота, читаются из окружения один раз при импорте"""
+
+    bot_token: str
+    database_url: str
+    # Создавать схему БД при запуске бота (INIT_DB=1); обычно схема создаётся
+    # один раз командой python -m bot.models.database
+    init_db: bool
+    # Отладочный режим: уровень логов DEBUG и логирование каждого обновления
+    debug: bool
+
+
+def _load_config() -> Config:
+    bot_token = os.getenv("BOT_TOKEN")
+    if not bot_token:
+        raise ValueError("BOT_TOKEN не найден в переменных окружения!")
+
+    return Config(
+        bot_token=bot_token,
+        database_url=os.getenv("DATABASE_URL", "sqlite:///checklist_bot.db"),
+        init_db=os.getenv("INIT_DB") == "1",
+        debug=os.getenv("BOT_DEBUG") == "1",
+    )
+
+
+config = _load_config()